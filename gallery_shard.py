@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Gallery Shards for the Nudibranch Species Identifier
+
+Splits the reference gallery across local worker processes. Each worker
+serves one slice of the gallery from a memory-mapped file and answers query
+embeddings sent over a local socket with its best scoring species, which
+ShardedGallery merges across shards.
+
+Worker usage: gallery_shard.py <socket path> <embeddings .npy> <species starts .npy>
+
+The embeddings must be L2-normalised and sorted by species, with the species
+starts file holding the first row of each species. The connection authkey is
+read from the NUDIBRANCH_SHARD_AUTHKEY environment variable.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import numpy as np
+from multiprocessing.connection import Client, Listener, wait
+
+AUTHKEY_ENV = "NUDIBRANCH_SHARD_AUTHKEY"
+SHARD_SCRIPT = os.path.abspath(__file__)
+RESTART_DELAY = 0.5  # Seconds before retrying a failed shard restart, doubled on each failure
+MAX_RESTART_DELAY = 30.0
+
+def top_species(embeddings, starts, query, top_k):
+    """Return (species index, score) pairs for the best scoring species."""
+    if len(starts) == 0:
+        return []
+    scores = embeddings @ query
+    # Rows are grouped by species, so each group's best score is one reduceat
+    best = np.maximum.reduceat(scores, starts)
+    k = min(top_k, len(best))
+    top = np.argpartition(-best, k - 1)[:k]
+    return [(int(i), float(best[i])) for i in top]
+
+def serve(address, embeddings_path, starts_path):
+    """Answer queries from the identifier until it disconnects."""
+    embeddings = np.load(embeddings_path, mmap_mode='r')
+    starts = np.load(starts_path)
+    authkey = bytes.fromhex(os.environ[AUTHKEY_ENV])
+
+    with Listener(address, family='AF_UNIX', authkey=authkey) as listener:
+        with listener.accept() as conn:
+            while True:
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    break
+                if message is None:
+                    break
+                query_id, query, top_k = message
+                conn.send((query_id, top_species(embeddings, starts, query, top_k)))
+
+class ShardedGallery:
+    """The reference gallery split across local shard processes.
+
+    Each shard runs this script on a memory-mapped slice of the embeddings
+    and returns its best scoring species for a query, which are merged here.
+    Shards that don't answer within the timeout are left out and the result
+    is flagged as partial. A shard that dies, or falls max_outstanding
+    queries behind, is killed and replaced in the background, retrying with
+    a growing delay until the new process is up.
+    """
+
+    def __init__(self, embeddings, labels, shard_count, timeout=0.5, start_timeout=30.0,
+                 max_outstanding=2):
+        self.timeout = timeout
+        self.start_timeout = start_timeout
+        self.max_outstanding = max_outstanding
+        self.directory = tempfile.mkdtemp(prefix="nudibranch-shards-")
+        self.processes = []
+        self.connections = []
+        self.labels = []
+        self._commands = []
+        self._outstanding = []
+        self._restarting = set()
+        self._retry_at = []
+        self._restart_delay = []
+        self._missing = set()
+        self._authkey = os.urandom(16)
+        self._env = dict(os.environ, **{AUTHKEY_ENV: self._authkey.hex()})
+        self._lock = threading.Lock()
+        self._query_id = 0
+        self._closed = False
+        try:
+            self._start(embeddings, labels, shard_count)
+        except Exception:
+            self.close()
+            raise
+
+    def _start(self, embeddings, labels, shard_count):
+        # Sort by species so each shard can take per-species maxima in one pass
+        order = sorted(range(len(labels)), key=labels.__getitem__)
+        embeddings = embeddings[order]
+        labels = [labels[i] for i in order]
+
+        bounds = np.linspace(0, len(labels), min(shard_count, len(labels)) + 1).astype(int)
+        for shard, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            shard_labels = labels[start:end]
+            starts = [i for i in range(len(shard_labels))
+                      if i == 0 or shard_labels[i] != shard_labels[i - 1]]
+            embeddings_path = os.path.join(self.directory, f"shard-{shard}.npy")
+            starts_path = os.path.join(self.directory, f"shard-{shard}-starts.npy")
+            np.save(embeddings_path, embeddings[start:end])
+            np.save(starts_path, np.asarray(starts, dtype=np.int64))
+            self.labels.append([shard_labels[i] for i in starts])
+
+            address = os.path.join(self.directory, f"shard-{shard}.sock")
+            self._commands.append([sys.executable, SHARD_SCRIPT, address,
+                                   embeddings_path, starts_path])
+            self.processes.append(self._spawn(shard))
+            self.connections.append(None)
+            self._outstanding.append(0)
+            self._retry_at.append(0.0)
+            self._restart_delay.append(RESTART_DELAY)
+
+        deadline = time.monotonic() + self.start_timeout
+        for shard, process in enumerate(self.processes):
+            self.connections[shard] = self._connect(shard, process, deadline)
+
+    def _spawn(self, shard):
+        return subprocess.Popen(self._commands[shard], env=self._env)
+
+    def _connect(self, shard, process, deadline):
+        # The shard creates its socket once its slice is mapped, so retry until then
+        address = self._commands[shard][2]
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"Gallery shard {shard} exited during startup")
+            try:
+                return Client(address, family='AF_UNIX', authkey=self._authkey)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Gallery shard {shard} did not start within "
+                                       f"{self.start_timeout}s")
+                time.sleep(0.05)
+
+    def search(self, query, top_k, timeout=None):
+        """Return the best score per species and the number of shards that didn't answer."""
+        timeout = self.timeout if timeout is None else timeout
+        with self._lock:
+            self._query_id += 1
+            query_id = self._query_id
+
+            # Scatter the query to every live shard. Sends only block once the
+            # socket buffer is full, and capping the unanswered queries per
+            # shard keeps a hung shard from ever filling it.
+            pending = {}
+            for shard, conn in enumerate(self.connections):
+                if conn is None:
+                    # Retry shards whose last restart failed once their delay is up
+                    if shard not in self._restarting and time.monotonic() >= self._retry_at[shard]:
+                        self._schedule_restart(shard)
+                    continue
+                if not self._collect_late_replies(shard):
+                    continue
+                if self._outstanding[shard] >= self.max_outstanding:
+                    print(f"Gallery shard {shard} has {self._outstanding[shard]} "
+                          f"unanswered queries")
+                    self._replace(shard)
+                    continue
+                try:
+                    conn.send((query_id, query, top_k))
+                except OSError:
+                    self._replace(shard)
+                    continue
+                self._outstanding[shard] += 1
+                pending[conn] = shard
+
+            # Gather replies until all shards have answered or the deadline passes
+            best = {}
+            answered = set()
+            deadline = time.monotonic() + timeout
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                for conn in wait(list(pending), remaining):
+                    shard = pending[conn]
+                    try:
+                        reply_id, results = conn.recv()
+                    except (EOFError, OSError):
+                        del pending[conn]
+                        self._replace(shard)
+                        continue
+                    self._outstanding[shard] -= 1
+                    if reply_id != query_id:
+                        # Late reply to an earlier query that timed out
+                        continue
+                    del pending[conn]
+                    answered.add(shard)
+                    for species, score in results:
+                        label = self.labels[shard][species]
+                        if score > best.get(label, -1.0):
+                            best[label] = score
+
+            # Only log when the set of missing shards changes, not on every query
+            missing = set(range(len(self.connections))) - answered
+            if missing != self._missing:
+                if missing:
+                    print(f"Gallery shards {sorted(missing)} of {len(self.connections)} "
+                          f"are not answering, results are partial")
+                else:
+                    print("All gallery shards are answering again")
+                self._missing = missing
+            return best, len(missing)
+
+    def _collect_late_replies(self, shard):
+        # Discard replies to queries that already timed out, returns False if the shard died
+        conn = self.connections[shard]
+        try:
+            while self._outstanding[shard] and conn.poll(0):
+                conn.recv()
+                self._outstanding[shard] -= 1
+        except (EOFError, OSError):
+            self._replace(shard)
+            return False
+        return True
+
+    def _replace(self, shard):
+        # Called with the lock held; the new process is started in the background
+        print(f"Gallery shard {shard} is unresponsive, restarting it")
+        self.connections[shard].close()
+        self.connections[shard] = None
+        self._outstanding[shard] = 0
+        self.processes[shard].kill()
+        self.processes[shard].wait()
+        self._schedule_restart(shard)
+
+    def _schedule_restart(self, shard):
+        # Called with the lock held
+        if self._closed or shard in self._restarting:
+            return
+        self._restarting.add(shard)
+        threading.Thread(target=self._restart, args=(shard,), daemon=True).start()
+
+    def _restart(self, shard):
+        process = None
+        try:
+            with self._lock:
+                if self._closed:
+                    self._restarting.discard(shard)
+                    return
+                # A killed shard leaves its socket file behind
+                try:
+                    os.unlink(self._commands[shard][2])
+                except FileNotFoundError:
+                    pass
+                process = self._spawn(shard)
+                self.processes[shard] = process
+            conn = self._connect(shard, process, time.monotonic() + self.start_timeout)
+        except Exception as e:
+            if process is not None:
+                process.kill()
+                process.wait()
+            with self._lock:
+                delay = self._restart_delay[shard]
+                self._retry_at[shard] = time.monotonic() + delay
+                self._restart_delay[shard] = min(delay * 2, MAX_RESTART_DELAY)
+                self._restarting.discard(shard)
+            print(f"Could not restart gallery shard {shard}, retrying in {delay}s: {e!r}")
+            return
+
+        with self._lock:
+            self._restarting.discard(shard)
+            if self._closed:
+                conn.close()
+                return
+            self.connections[shard] = conn
+            self._outstanding[shard] = 0
+            self._restart_delay[shard] = RESTART_DELAY
+        print(f"Gallery shard {shard} restarted")
+
+    def close(self):
+        """Stop the shard processes and remove their files."""
+        with self._lock:
+            self._closed = True
+            for shard, process in enumerate(self.processes):
+                conn = self.connections[shard]
+                if conn is None:
+                    process.kill()
+                    continue
+                try:
+                    conn.send(None)
+                    conn.close()
+                except OSError:
+                    pass
+            for process in self.processes:
+                try:
+                    process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+            self.connections = []
+            self.processes = []
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    try:
+        serve(*sys.argv[1:4])
+    except KeyboardInterrupt:
+        # Ctrl+C reaches the whole process group, the identifier cleans up
+        pass
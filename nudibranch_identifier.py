@@ -10,20 +10,57 @@ a nudibranch species database.
 """
 
 import os
+import re
 import sys
 import json
+import uuid
+import shutil
+import pstats
+import cProfile
+import signal
+import tempfile
+import threading
+import time
 import requests
 import numpy as np
 import webbrowser
 from datetime import datetime
-from http.server import HTTPServer, SimpleHTTPRequesstHandler
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlparse, parse_qs
+from http.server import HTTPServer, SimpleHTTPRequestHandler
 import tensorflow as tf
 import tensorflow_hub as hub
+from gallery_shard import ShardedGallery
 
 # Configuration
 PORT = 8000
 NUDIBRANCH_DB_FILE = "nudibranch_db.json"
 MODEL_URL = "https://tfhub.dev/google/imagenet/mobilenet_v2_100_224/feature_vector/4"
+IMAGE_SIZE = (224, 224)
+TOP_K = 3
+
+# Hot reload configuration
+# The gallery is an optional .npz file with an "embeddings" array (N x D) and
+# a "labels" array of "Genus species" strings, one per embedding.
+GALLERY_FILE = "nudibranch_gallery.npz"
+RELOAD_POLL_INTERVAL = 2.0  # Seconds between file watcher checks, 0 disables it
+DRAIN_TIMEOUT = 60.0  # Seconds to wait for in-flight requests before releasing a snapshot
+ADMIN_CLIENTS = ("127.0.0.1", "::1")
+
+# Sharded gallery configuration
+SHARD_COUNT = 0  # Number of local shard processes for the gallery, 0 or 1 matches in-process
+SHARD_TIMEOUT = 0.5  # Seconds to wait for shard replies before returning partial results
+SHARD_WARM_UP_TIMEOUT = 60.0  # Deadline for the first, cold scan of freshly written shards
+SHARD_START_TIMEOUT = 30.0  # Seconds to wait for the shard processes to come up
+SHARD_MAX_OUTSTANDING = 2  # Unanswered queries after which a shard is restarted
+
+# Profiling configuration
+# Captures live outside the directory served to clients, they can reveal a lot about the server
+PROFILE_DIR = os.path.join(os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state"),
+                           "nudibranch_identifier", "profiles")
+PROFILE_HEADER = "X-Profile"  # Send "X-Profile: 1" to profile a single request
+PROFILE_MIN_INTERVAL = 10.0  # Minimum seconds between two captures
+PROFILE_MAX_CAPTURES = 50  # Oldest captures are deleted beyond this
 
 # Nudibranch database - simplified for demonstration
 # In a real app, this would be more comprehensive
@@ -126,7 +163,37 @@ def save_nudibranch_db():
         json.dump(NUDIBRANCH_DB, f, indent=2)
     print(f"Nudibranch database saved to {NUDIBRANCH_DB_FILE}")
 
-def load_feature_extractor():
+def load_nudibranch_db():
+    """Load the nudibranch database from its file."""
+    with open(NUDIBRANCH_DB_FILE) as f:
+        catalogue = json.load(f)
+    if not isinstance(catalogue, list):
+        raise ValueError(f"{NUDIBRANCH_DB_FILE} must contain a list of species")
+    for entry in catalogue:
+        if "genus" not in entry or "species" not in entry:
+            raise ValueError(f"Species entry without genus/species in {NUDIBRANCH_DB_FILE}: {entry}")
+    return catalogue
+
+def load_gallery(catalogue):
+    """Load the reference embedding gallery, or None if there isn't one."""
+    if not os.path.exists(GALLERY_FILE):
+        return None
+    with np.load(GALLERY_FILE, allow_pickle=False) as data:
+        embeddings = np.asarray(data["embeddings"], dtype=np.float32)
+        labels = [str(label) for label in data["labels"]]
+    if embeddings.ndim != 2 or len(embeddings) != len(labels):
+        raise ValueError(f"{GALLERY_FILE} must hold one label per embedding row")
+    # Drop images of species that aren't in the catalogue
+    known = {f"{entry['genus']} {entry['species']}" for entry in catalogue}
+    keep = [i for i, label in enumerate(labels) if label in known]
+    embeddings = embeddings[keep]
+    labels = [labels[i] for i in keep]
+    # Normalise once here so matching is a single matrix product
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings = embeddings / np.maximum(norms, 1e-12)
+    return embeddings, labels
+
+def load_feature_extractor(exit_on_error=True):
     """Load the pre-trained model for feature extraction."""
     print("Loading pre-trained model for feature extraction...")
     try:
@@ -135,10 +202,376 @@ def load_feature_extractor():
         return model
     except Exception as e:
         print(f"Error loading model: {e}")
+        if not exit_on_error:
+            raise
         print("Please make sure you have an internet connection and tensorflow-hub is installed.")
         print("You can install it with: pip install tensorflow-hub")
         sys.exit(1)
 
+def source_mtimes():
+    """Return the modification times of the files a snapshot is built from."""
+    paths = [NUDIBRANCH_DB_FILE, GALLERY_FILE]
+    # Only a model on local disk can be watched; hub URLs are reloaded on demand
+    if os.path.exists(MODEL_URL):
+        paths.append(MODEL_URL)
+    mtimes = {}
+    for path in paths:
+        # Files can be deleted or replaced at any moment, treat those as missing
+        try:
+            mtimes[path] = os.path.getmtime(path)
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+class AppSnapshot:
+    """A consistent catalogue, gallery and model used to serve requests.
+
+    Requests hold a reference for their whole duration, so a reload never
+    mixes the species data of one version with the model of another.
+    """
+
+    def __init__(self, generation, catalogue, gallery, shards, feature_extractor, sources):
+        self.generation = generation
+        self.catalogue = catalogue
+        self.species_index = {f"{entry['genus']} {entry['species']}": entry for entry in catalogue}
+        self.gallery = gallery
+        self.shards = shards
+        self.feature_extractor = feature_extractor
+        self.sources = sources
+        self._in_flight = 0
+        self._drained = threading.Condition()
+
+    def acquire(self):
+        with self._drained:
+            self._in_flight += 1
+
+    def release(self):
+        with self._drained:
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self._drained.notify_all()
+
+    def wait_drained(self, timeout=None):
+        """Block until no request is using this snapshot, returning True on success."""
+        with self._drained:
+            return self._drained.wait_for(lambda: self._in_flight == 0, timeout)
+
+    def close(self):
+        """Drop the references to the model and data so they can be freed."""
+        self.feature_extractor = None
+        self.gallery = None
+        if self.shards is not None:
+            self.shards.close()
+            self.shards = None
+        self.catalogue = []
+        self.species_index = {}
+
+    def extract_features(self, img_array):
+        """Run the model on a preprocessed batch and return a numpy array."""
+        return np.asarray(self.feature_extractor(img_array))
+
+    def match(self, features, top_k=TOP_K, shard_timeout=SHARD_TIMEOUT):
+        """Return the best matching species for a feature vector.
+
+        The second value is True when some gallery shards didn't answer in
+        time and the matches only cover part of the gallery.
+        """
+        partial = False
+        if self.gallery is None and self.shards is None:
+            # No reference gallery yet, fall back to the demonstration matcher
+            import random
+            matches = random.sample(self.catalogue, min(top_k, len(self.catalogue)))
+            matches = [dict(match, score=random.uniform(0.65, 0.95)) for match in matches]
+        else:
+            query = np.asarray(features, dtype=np.float32).reshape(-1)
+            query = query / max(float(np.linalg.norm(query)), 1e-12)
+            if self.shards is not None:
+                best, missing = self.shards.search(query, top_k, timeout=shard_timeout)
+                partial = missing > 0
+            else:
+                embeddings, labels = self.gallery
+                scores = embeddings @ query
+                best = {}
+                for label, score in zip(labels, scores.tolist()):
+                    if score > best.get(label, -1.0):
+                        best[label] = score
+            ranked = sorted(best.items(), key=lambda item: item[1], reverse=True)[:top_k]
+            matches = [dict(self.species_index[label], score=score) for label, score in ranked]
+
+        # Sort by score descending
+        matches.sort(key=lambda x: x['score'], reverse=True)
+        return matches, partial
+
+    def warm_up(self):
+        """Run a dummy image through the model and matcher before serving traffic."""
+        dummy = tf.zeros((1,) + IMAGE_SIZE + (3,))
+        _, partial = self.match(self.extract_features(dummy), shard_timeout=SHARD_WARM_UP_TIMEOUT)
+        if partial:
+            raise RuntimeError("Not all gallery shards answered the warm-up query")
+
+class SnapshotManager:
+    """Builds snapshots in the background and swaps them in between requests."""
+
+    def __init__(self):
+        self._current = None
+        self._generation = 0
+        self._swap_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._failed_sources = None
+        self._pending_lock = threading.Lock()
+        self._reloading = False
+        self._pending = None
+
+    @property
+    def generation(self):
+        return self._generation
+
+    @contextmanager
+    def snapshot(self):
+        """Pin the current snapshot for the duration of a request."""
+        with self._swap_lock:
+            snapshot = self._current
+            snapshot.acquire()
+        try:
+            yield snapshot
+        finally:
+            snapshot.release()
+
+    def reload(self, reload_model=False):
+        """Build, warm up and swap in a new snapshot. Returns True on success."""
+        with self._reload_lock:
+            previous = self._current
+            sources = source_mtimes()
+            snapshot = None
+            shards = None
+            try:
+                catalogue = load_nudibranch_db()
+                gallery = load_gallery(catalogue)
+                gallery_size = 0 if gallery is None else len(gallery[1])
+                if previous is None or reload_model:
+                    feature_extractor = load_feature_extractor(exit_on_error=previous is None)
+                else:
+                    feature_extractor = previous.feature_extractor
+                if gallery is not None and gallery_size > 0 and SHARD_COUNT > 1:
+                    # The shards hold their own copies, don't keep one here as well
+                    shards = ShardedGallery(*gallery, SHARD_COUNT, timeout=SHARD_TIMEOUT,
+                                            start_timeout=SHARD_START_TIMEOUT,
+                                            max_outstanding=SHARD_MAX_OUTSTANDING)
+                    gallery = None
+                snapshot = AppSnapshot(self._generation + 1, catalogue, gallery, shards,
+                                       feature_extractor, sources)
+                snapshot.warm_up()
+            except Exception as e:
+                if snapshot is not None:
+                    snapshot.close()
+                elif shards is not None:
+                    shards.close()
+                if previous is None:
+                    raise
+                self._failed_sources = sources
+                print(f"Reload failed, still serving generation {previous.generation}: {e}")
+                return False
+
+            with self._swap_lock:
+                self._current = snapshot
+                self._generation = snapshot.generation
+            self._failed_sources = None
+            print(f"Serving generation {snapshot.generation} ({len(catalogue)} species, "
+                  f"{gallery_size} gallery images, {len(shards.connections) if shards else 0} shards)")
+
+        if previous is not None:
+            threading.Thread(target=self._retire, args=(previous,), daemon=True).start()
+        return True
+
+    def reload_async(self, reload_model=False):
+        """Start a reload in a background thread.
+
+        If one is already queued or running, another reload is queued to run
+        after it, so a model reload is never folded into one without it.
+        Returns False when the reload was queued rather than started.
+        """
+        with self._pending_lock:
+            if self._reloading:
+                self._pending = bool(self._pending) or reload_model
+                print("Reload already in progress, queued another one")
+                return False
+            self._reloading = True
+        threading.Thread(target=self._reload_queued, args=(reload_model,), daemon=True).start()
+        return True
+
+    def _reload_queued(self, reload_model):
+        while True:
+            try:
+                self.reload(reload_model=reload_model)
+            except Exception as e:
+                print(f"Reload failed: {e}")
+            with self._pending_lock:
+                if self._pending is None:
+                    self._reloading = False
+                    return
+                reload_model, self._pending = self._pending, None
+
+    def _retire(self, snapshot):
+        if not snapshot.wait_drained(DRAIN_TIMEOUT):
+            print(f"Generation {snapshot.generation} still has requests in flight after "
+                  f"{DRAIN_TIMEOUT}s")
+            snapshot.wait_drained()
+        snapshot.close()
+        print(f"Released generation {snapshot.generation}")
+
+    def close(self):
+        """Release the current snapshot when the server shuts down."""
+        with self._reload_lock:
+            if self._current is not None:
+                self._current.close()
+
+    def watch(self, interval=RELOAD_POLL_INTERVAL):
+        """Poll the source files and reload when any of them change."""
+        def poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    sources = source_mtimes()
+                    if sources == self._current.sources or sources == self._failed_sources:
+                        continue
+                    model_changed = MODEL_URL in sources and \
+                        sources[MODEL_URL] != self._current.sources.get(MODEL_URL)
+                    self.reload(reload_model=model_changed)
+                except Exception as e:
+                    # Keep watching, the next change may well load fine
+                    print(f"File watcher error: {e}")
+
+        threading.Thread(target=poll, daemon=True).start()
+
+class ProfileCapture:
+    """Python and TensorFlow profiles of a single identify request."""
+
+    def __init__(self, request_id, path):
+        self.request_id = request_id
+        self.path = path
+        self.profile = cProfile.Profile()
+        self.started = time.time()
+        self.generation = None
+        self.tf_trace = False
+
+    @contextmanager
+    def trace_tensorflow(self):
+        """Record a TensorFlow profiler trace of the enclosed block."""
+        logdir = os.path.join(self.path, "tensorflow")
+        try:
+            tf.profiler.experimental.start(logdir)
+        except Exception as e:
+            # Another trace may already be running, keep the Python profile anyway
+            print(f"Could not start TensorFlow profiler: {e}")
+            yield
+            return
+        try:
+            yield
+        finally:
+            tf.profiler.experimental.stop()
+            self.tf_trace = True
+
+    def save(self):
+        """Write the profiles and a metadata file describing the capture."""
+        duration_ms = (time.time() - self.started) * 1000
+        self.profile.dump_stats(os.path.join(self.path, "python.prof"))
+        with open(os.path.join(self.path, "python.txt"), 'w') as f:
+            stats = pstats.Stats(self.profile, stream=f)
+            stats.sort_stats("cumulative").print_stats(40)
+        metadata = {
+            "request_id": self.request_id,
+            "timestamp": datetime.fromtimestamp(self.started).isoformat(),
+            "duration_ms": round(duration_ms, 1),
+            "generation": self.generation,
+            "python_profile": os.path.join(self.path, "python.prof"),
+            "tensorflow_trace": os.path.join(self.path, "tensorflow") if self.tf_trace else None,
+        }
+        with open(os.path.join(self.path, "capture.json"), 'w') as f:
+            json.dump(metadata, f, indent=2)
+        return metadata
+
+class Profiler:
+    """Opt-in, rate-limited profiling of identify requests.
+
+    A capture is taken when a local request carries the profiling header or
+    when profiling has been switched on through the admin endpoint, but never
+    more often than once every PROFILE_MIN_INTERVAL seconds.
+    """
+
+    def __init__(self, directory=PROFILE_DIR, min_interval=PROFILE_MIN_INTERVAL,
+                 max_captures=PROFILE_MAX_CAPTURES):
+        self.directory = directory
+        self.min_interval = min_interval
+        self.max_captures = max_captures
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._last_capture = None
+
+    def start_capture(self, headers, client_host):
+        """Return a new capture for this request, or None if it isn't profiled."""
+        # Remote clients could otherwise use up the rate limit with costly traces
+        requested = client_host in ADMIN_CLIENTS and \
+            headers.get(PROFILE_HEADER, '').lower() in ('1', 'true', 'yes')
+        if not (requested or self.enabled):
+            return None
+        with self._lock:
+            now = time.monotonic()
+            if self._last_capture is not None and now - self._last_capture < self.min_interval:
+                return None
+            self._last_capture = now
+
+        request_id = self._request_id(headers.get('X-Request-ID', ''))
+        path = os.path.join(self.directory, request_id)
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            # Profiling is a diagnostic, serve the request without it
+            print(f"Could not create profile directory {path}: {e}")
+            return None
+        return ProfileCapture(request_id, path)
+
+    def finish(self, capture):
+        """Save a capture and prune old ones."""
+        try:
+            metadata = capture.save()
+            print(f"Saved profile {capture.request_id} ({metadata['duration_ms']} ms)")
+        except Exception as e:
+            print(f"Error saving profile {capture.request_id}: {e}")
+            shutil.rmtree(capture.path, ignore_errors=True)
+        self.prune()
+
+    def prune(self):
+        """Delete the oldest capture directories beyond max_captures."""
+        # Go by directory rather than metadata so broken captures are pruned too
+        try:
+            paths = [entry.path for entry in os.scandir(self.directory) if entry.is_dir()]
+        except OSError:
+            return
+        paths.sort(key=lambda path: os.stat(path).st_mtime_ns, reverse=True)
+        for path in paths[self.max_captures:]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def captures(self, limit=None):
+        """Return the metadata of saved captures, most recent first."""
+        if not os.path.isdir(self.directory):
+            return []
+        captures = []
+        for name in os.listdir(self.directory):
+            try:
+                with open(os.path.join(self.directory, name, "capture.json")) as f:
+                    captures.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        captures.sort(key=lambda metadata: metadata["timestamp"], reverse=True)
+        return captures[:limit]
+
+    def _request_id(self, requested_id):
+        # Client supplied ids become directory names, so only accept safe ones
+        if re.fullmatch(r'[A-Za-z0-9_-]{1,64}', requested_id) and \
+                not os.path.exists(os.path.join(self.directory, requested_id)):
+            return requested_id
+        return f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}"
+
 def create_html_file():
     """Create the HTML file for the web application."""
     html_file = "nudibranch_identifier.html"
@@ -550,99 +983,177 @@ def create_html_file():
 class NudibranchRequestHandler(SimpleHTTPRequestHandler):
     """Custom request handler for the nudibranch identifier app."""
     
-    feature_extractor = None
+    snapshots = None
+    profiler = None
+    
+    def do_GET(self):
+        """Serve the admin endpoints and fall back to static files."""
+        url = urlparse(self.path)
+        if url.path == '/admin/profiles':
+            self.handle_list_profiles(parse_qs(url.query))
+        else:
+            super().do_GET()
     
     def do_POST(self):
         """Handle POST requests from the web app."""
-        if self.path == '/identify':
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            
-            # Save the uploaded image
-            import tempfile
-            from PIL import Image
-            import io
-            
-            # Find boundary in the multipart/form-data
-            boundary = self.headers['Content-Type'].split('=')[1].encode()
-            
-            # Parse the form data to get the image
-            post_data = post_data.split(boundary)
-            # Look for the part that contains the image data
-            for part in post_data:
-                if b'Content-Type: image/' in part:
-                    # Extract the image data
-                    image_data = part.split(b'\r\n\r\n')[1].split(b'\r\n--')[0]
-                    break
-            else:
-                self.send_error(400, "No image found in request")
+        url = urlparse(self.path)
+        if url.path == '/admin/reload':
+            self.handle_reload(parse_qs(url.query))
+        elif url.path == '/admin/profiling':
+            self.handle_profiling(parse_qs(url.query))
+        elif url.path == '/identify':
+            capture = NudibranchRequestHandler.profiler.start_capture(
+                self.headers, self.client_address[0])
+            if capture is None:
+                self.handle_identify()
                 return
-            
-            # Save the image to a temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-                temp_file.write(image_data)
-                temp_filename = temp_file.name
-            
-            # Process the image with our nudibranch identifier
-            matches = self.identify_nudibranch(temp_filename)
-            
-            # Clean up the temporary file
-            os.unlink(temp_filename)
-            
-            # Send response
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            
-            # Send the identification results
-            self.wfile.write(json.dumps({"matches": matches}).encode())
+            capture.profile.enable()
+            try:
+                self.handle_identify(capture)
+            finally:
+                capture.profile.disable()
+                NudibranchRequestHandler.profiler.finish(capture)
         else:
             super().do_POST()
     
-    def identify_nudibranch(self, image_path):
+    def handle_identify(self, capture=None):
+        """Identify the species in an uploaded image."""
+        content_length = int(self.headers['Content-Length'])
+        post_data = self.rfile.read(content_length)
+        
+        # Save the uploaded image
+        from PIL import Image
+        import io
+        
+        # Find boundary in the multipart/form-data
+        boundary = self.headers['Content-Type'].split('=')[1].encode()
+        
+        # Parse the form data to get the image
+        post_data = post_data.split(boundary)
+        # Look for the part that contains the image data
+        for part in post_data:
+            if b'Content-Type: image/' in part:
+                # Extract the image data
+                image_data = part.split(b'\r\n\r\n')[1].split(b'\r\n--')[0]
+                break
+        else:
+            self.send_error(400, "No image found in request")
+            return
+        
+        # Save the image to a temporary file
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
+            temp_file.write(image_data)
+            temp_filename = temp_file.name
+        
+        # Process the image with our nudibranch identifier, all against
+        # one snapshot even if a reload finishes meanwhile
+        with NudibranchRequestHandler.snapshots.snapshot() as snapshot:
+            if capture is not None:
+                capture.generation = snapshot.generation
+            matches, partial = self.identify_nudibranch(temp_filename, snapshot, capture)
+        
+        # Clean up the temporary file
+        os.unlink(temp_filename)
+        
+        # Send response
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        if capture is not None:
+            self.send_header('X-Profile-Id', capture.request_id)
+        self.end_headers()
+        
+        # Send the identification results
+        self.wfile.write(json.dumps({"matches": matches, "partial": partial}).encode())
+    
+    def is_admin_request(self):
+        """Reject admin requests that don't come from the local machine."""
+        if self.client_address[0] in ADMIN_CLIENTS:
+            return True
+        self.send_error(403, "Admin endpoints are only available locally")
+        return False
+    
+    def send_json(self, status, payload):
+        """Send a JSON response."""
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(payload).encode())
+    
+    def handle_reload(self, params):
+        """Trigger a background reload of the catalogue, gallery and model."""
+        if not self.is_admin_request():
+            return
+        reload_model = params.get('model', ['0'])[0] in ('1', 'true', 'yes')
+        started = NudibranchRequestHandler.snapshots.reload_async(reload_model=reload_model)
+        self.send_json(202, {
+            "reloading": started,
+            "generation": NudibranchRequestHandler.snapshots.generation,
+        })
+    
+    def handle_profiling(self, params):
+        """Switch profiling of all identify requests on or off."""
+        if not self.is_admin_request():
+            return
+        profiler = NudibranchRequestHandler.profiler
+        if 'enabled' in params:
+            profiler.enabled = params['enabled'][0] in ('1', 'true', 'yes')
+        self.send_json(200, {"enabled": profiler.enabled, "min_interval": profiler.min_interval})
+    
+    def handle_list_profiles(self, params):
+        """List the most recent profile captures."""
+        if not self.is_admin_request():
+            return
+        try:
+            limit = int(params.get('limit', ['20'])[0])
+        except ValueError:
+            limit = -1
+        if limit < 0:
+            self.send_error(400, "limit must be a non-negative integer")
+            return
+        self.send_json(200, {"captures": NudibranchRequestHandler.profiler.captures(limit)})
+    
+    def identify_nudibranch(self, image_path, snapshot, capture=None):
         """Identify possible nudibranch species from an image."""
         try:
             # Load and preprocess the image
-            img = tf.keras.preprocessing.image.load_img(image_path, target_size=(224, 224))
+            img = tf.keras.preprocessing.image.load_img(image_path, target_size=IMAGE_SIZE)
             img_array = tf.keras.preprocessing.image.img_to_array(img)
             img_array = tf.expand_dims(img_array, 0)
             img_array = tf.keras.applications.mobilenet_v2.preprocess_input(img_array)
             
-            # Initialize the feature extractor if it's not already loaded
-            if NudibranchRequestHandler.feature_extractor is None:
-                NudibranchRequestHandler.feature_extractor = load_feature_extractor()
-            
             # Extract features from the image
-            features = NudibranchRequestHandler.feature_extractor(img_array)
-            
-            # For demonstration, we'll use a simplified matching algorithm
-            # In a real-world app, you'd use more sophisticated methods
-            
-            # Get the top matching species (for demo, just return random ones with random scores)
-            # In a real system, this would do actual feature comparison
-            import random
+            with capture.trace_tensorflow() if capture is not None else nullcontext():
+                features = snapshot.extract_features(img_array)
             
-            # For demonstration, return 3 random species with random scores
-            matches = random.sample(NUDIBRANCH_DB, min(3, len(NUDIBRANCH_DB)))
-            
-            # Assign random scores for demonstration
-            for match in matches:
-                match['score'] = random.uniform(0.65, 0.95)
-            
-            # Sort by score descending
-            matches.sort(key=lambda x: x['score'], reverse=True)
-            
-            return matches
+            # Compare against the reference gallery, or return demonstration
+            # matches when no gallery has been built yet
+            return snapshot.match(features)
         except Exception as e:
             print(f"Error identifying nudibranch: {e}")
-            return []
+            return [], False
 
 def main():
     """Run the nudibranch identifier app."""
     print("Starting Nudibranch Species Identifier...")
     
-    # Save the nudibranch database to a file
-    save_nudibranch_db()
+    # Save the built-in nudibranch database unless one is already there,
+    # so edits to the file survive restarts and can be hot reloaded
+    if not os.path.exists(NUDIBRANCH_DB_FILE):
+        save_nudibranch_db()
+    
+    # Load and warm up the catalogue, gallery and model before serving
+    snapshots = SnapshotManager()
+    snapshots.reload(reload_model=True)
+    NudibranchRequestHandler.snapshots = snapshots
+    NudibranchRequestHandler.profiler = Profiler()
+    
+    # Reload on file changes, SIGHUP or POST /admin/reload
+    if RELOAD_POLL_INTERVAL > 0:
+        snapshots.watch()
+    if hasattr(signal, 'SIGHUP'):
+        # Hand off to a thread, the handler may interrupt code holding the reload locks
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=snapshots.reload_async, kwargs={"reload_model": True}, daemon=True).start())
     
     # Create the HTML file
     html_file = create_html_file()
@@ -664,6 +1175,7 @@ def main():
     except KeyboardInterrupt:
         print("\nShutting down the server...")
         httpd.server_close()
+        snapshots.close()
         print("Server stopped.")
 
 if __name__ == "__main__":
@@ -0,0 +1,172 @@
+"""Tests for the sharded gallery, checked against brute-force matching."""
+
+import os
+import signal
+import time
+
+from multiprocessing import AuthenticationError
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from gallery_shard import ShardedGallery, top_species
+
+SPECIES = [f"Genus species{i}" for i in range(12)]
+
+def make_gallery(rows=300, dims=32, seed=0):
+    rng = np.random.default_rng(seed)
+    labels = [SPECIES[i] for i in rng.integers(len(SPECIES), size=rows)]
+    embeddings = rng.normal(size=(rows, dims)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings, labels
+
+def brute_force(embeddings, labels, query, top_k):
+    best = {}
+    for label, score in zip(labels, (embeddings @ query).tolist()):
+        best[label] = max(score, best.get(label, -1.0))
+    return dict(sorted(best.items(), key=lambda item: item[1], reverse=True)[:top_k])
+
+def top(best, top_k):
+    return dict(sorted(best.items(), key=lambda item: item[1], reverse=True)[:top_k])
+
+def wait_until_complete(gallery, query, top_k, deadline=30.0):
+    end = time.monotonic() + deadline
+    while time.monotonic() < end:
+        best, missing = gallery.search(query, top_k)
+        if not missing:
+            return best
+        time.sleep(0.1)
+    pytest.fail("Gallery shards were not replaced in time")
+
+@pytest.fixture
+def gallery():
+    embeddings, labels = make_gallery()
+    sharded = ShardedGallery(embeddings, labels, 4, timeout=0.2)
+    yield embeddings, labels, sharded
+    sharded.close()
+
+def test_top_species_matches_brute_force():
+    embeddings, labels = make_gallery()
+    order = sorted(range(len(labels)), key=labels.__getitem__)
+    embeddings = embeddings[order]
+    labels = [labels[i] for i in order]
+    starts = [i for i in range(len(labels)) if i == 0 or labels[i] != labels[i - 1]]
+    species = [labels[i] for i in starts]
+    query = embeddings[7]
+
+    result = {species[i]: score for i, score in top_species(embeddings, np.asarray(starts), query, 3)}
+
+    assert result == pytest.approx(brute_force(embeddings, labels, query, 3))
+
+def test_top_species_empty_shard():
+    assert top_species(np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.int64),
+                       np.ones(4, dtype=np.float32), 3) == []
+
+@pytest.mark.parametrize("shard_count", [1, 3, 7])
+def test_search_matches_brute_force(shard_count):
+    embeddings, labels = make_gallery()
+    sharded = ShardedGallery(embeddings, labels, shard_count, timeout=5.0)
+    try:
+        rng = np.random.default_rng(1)
+        for _ in range(10):
+            query = rng.normal(size=embeddings.shape[1]).astype(np.float32)
+            best, missing = sharded.search(query, 3)
+            assert missing == 0
+            assert top(best, 3) == pytest.approx(brute_force(embeddings, labels, query, 3))
+    finally:
+        sharded.close()
+
+def test_dead_shard_gives_partial_results_and_is_replaced(gallery):
+    embeddings, labels, sharded = gallery
+    query = embeddings[0]
+
+    sharded.processes[1].kill()
+    sharded.processes[1].wait()
+    best, missing = sharded.search(query, 3)
+    assert missing == 1
+    assert best
+
+    best = wait_until_complete(sharded, query, 3)
+    assert top(best, 3) == pytest.approx(brute_force(embeddings, labels, query, 3))
+
+def flaky_connect(sharded, failures):
+    """Make the next `failures` shard connections fail, returning the attempt log."""
+    connect = sharded._connect
+    attempts = []
+
+    def failing_connect(shard, process, deadline):
+        attempts.append(shard)
+        if len(attempts) <= failures:
+            raise AuthenticationError("digest received was wrong")
+        return connect(shard, process, deadline)
+
+    sharded._connect = failing_connect
+    return attempts
+
+def test_failed_restart_is_retried(gallery):
+    embeddings, labels, sharded = gallery
+    query = embeddings[0]
+    attempts = flaky_connect(sharded, failures=1)
+
+    sharded.processes[1].kill()
+    sharded.processes[1].wait()
+    _, missing = sharded.search(query, 3)
+    assert missing == 1
+
+    best = wait_until_complete(sharded, query, 3)
+    assert attempts[:2] == [1, 1]
+    assert top(best, 3) == pytest.approx(brute_force(embeddings, labels, query, 3))
+
+def test_failed_restart_kills_new_process(gallery):
+    embeddings, labels, sharded = gallery
+    flaky_connect(sharded, failures=100)
+
+    sharded.processes[3].kill()
+    sharded.processes[3].wait()
+    sharded.search(embeddings[0], 3)
+    # Wait for the replacement to be spawned and given up on
+    time.sleep(0.3)
+    with sharded._lock:
+        assert 3 not in sharded._restarting
+        assert sharded.processes[3].poll() is not None
+
+def test_missing_shards_are_logged_once(gallery, capsys):
+    embeddings, labels, sharded = gallery
+    flaky_connect(sharded, failures=100)
+
+    sharded.processes[0].kill()
+    sharded.processes[0].wait()
+    for _ in range(5):
+        _, missing = sharded.search(embeddings[0], 3)
+        assert missing == 1
+
+    assert capsys.readouterr().out.count("are not answering") == 1
+
+def test_hung_shard_never_blocks_search():
+    # Full-size MobileNet embeddings, so unread queries would fill the socket buffer
+    embeddings, labels = make_gallery(dims=1280)
+    sharded = ShardedGallery(embeddings, labels, 4, timeout=0.2)
+    try:
+        query = np.ones(embeddings.shape[1], dtype=np.float32)
+        os.kill(sharded.processes[2].pid, signal.SIGSTOP)
+        start = time.monotonic()
+        for _ in range(50):
+            _, missing = sharded.search(query, 3)
+            assert missing <= 1
+        # Every search is bounded by the timeout even with a stopped shard
+        assert time.monotonic() - start < 50 * 0.2 + 5
+
+        best = wait_until_complete(sharded, query, 3)
+        assert top(best, 3) == pytest.approx(brute_force(embeddings, labels, query, 3))
+    finally:
+        sharded.close()
+
+def test_close_removes_shard_files():
+    embeddings, labels = make_gallery()
+    sharded = ShardedGallery(embeddings, labels, 2)
+    processes = list(sharded.processes)
+    sharded.close()
+
+    assert not os.path.exists(sharded.directory)
+    assert all(process.poll() is not None for process in processes)
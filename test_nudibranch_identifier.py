@@ -0,0 +1,195 @@
+"""Tests for the identifier's snapshot reloading and profiling, run without TensorFlow."""
+
+import json
+import os
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+# Stand-ins for TensorFlow, only what warm-up touches is needed here
+tf_stub = types.ModuleType("tensorflow")
+tf_stub.zeros = np.zeros
+sys.modules.setdefault("tensorflow", tf_stub)
+sys.modules.setdefault("tensorflow_hub", types.ModuleType("tensorflow_hub"))
+
+import nudibranch_identifier as ni
+
+def wait_for(condition, deadline=5.0):
+    end = time.monotonic() + deadline
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+@pytest.fixture
+def models(tmp_path, monkeypatch):
+    """Run in a scratch directory with a fake model, returning the loaded models."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ni, "MODEL_URL", "model-not-on-disk")
+    ni.save_nudibranch_db()
+    loaded = []
+
+    def load_feature_extractor(exit_on_error=True):
+        model = lambda img_array: np.ones((1, 8), dtype=np.float32)
+        loaded.append(model)
+        return model
+
+    monkeypatch.setattr(ni, "load_feature_extractor", load_feature_extractor)
+    return loaded
+
+@pytest.fixture
+def manager(models):
+    manager = ni.SnapshotManager()
+    manager.reload(reload_model=True)
+    yield manager
+    manager.close()
+
+def test_reload_swaps_in_new_generation(manager, models):
+    with open(ni.NUDIBRANCH_DB_FILE, 'w') as f:
+        json.dump(ni.NUDIBRANCH_DB[:2], f)
+
+    assert manager.reload()
+    with manager.snapshot() as snapshot:
+        assert snapshot.generation == 2
+        assert len(snapshot.catalogue) == 2
+        # The model is only reloaded when asked for
+        assert snapshot.feature_extractor is models[0]
+
+def test_failed_reload_keeps_previous_generation(manager):
+    with open(ni.NUDIBRANCH_DB_FILE, 'w') as f:
+        f.write("{not json")
+
+    assert not manager.reload()
+    assert manager.generation == 1
+    with manager.snapshot() as snapshot:
+        assert snapshot.generation == 1
+        assert len(snapshot.catalogue) == len(ni.NUDIBRANCH_DB)
+
+def test_pinned_snapshot_survives_swap_and_is_released_after(manager):
+    with manager.snapshot() as pinned:
+        assert manager.reload()
+        assert manager.generation == 2
+        # Give the retiring thread a chance to close the snapshot too early
+        time.sleep(0.1)
+        assert pinned.generation == 1
+        assert pinned.feature_extractor is not None
+        matches, partial = pinned.match(np.ones(8))
+        assert matches and not partial
+
+    assert wait_for(lambda: pinned.feature_extractor is None)
+    with manager.snapshot() as snapshot:
+        assert snapshot.generation == 2
+        assert snapshot.feature_extractor is not None
+
+def test_queued_model_reload_is_not_folded_into_running_reload(manager, models, monkeypatch):
+    started = threading.Event()
+    proceed = threading.Event()
+    load_nudibranch_db = ni.load_nudibranch_db
+
+    def slow_load_nudibranch_db():
+        started.set()
+        proceed.wait(5)
+        return load_nudibranch_db()
+
+    monkeypatch.setattr(ni, "load_nudibranch_db", slow_load_nudibranch_db)
+    assert manager.reload_async(reload_model=False)
+    assert started.wait(5)
+    assert not manager.reload_async(reload_model=True)
+    assert not manager.reload_async(reload_model=False)
+    proceed.set()
+
+    assert wait_for(lambda: manager.generation == 3 and not manager._reloading)
+    # One model for the initial load and one for the queued model reload
+    assert len(models) == 2
+    with manager.snapshot() as snapshot:
+        assert snapshot.feature_extractor is models[1]
+
+def test_source_mtimes_treats_missing_files_as_none(models):
+    mtimes = ni.source_mtimes()
+    assert mtimes[ni.NUDIBRANCH_DB_FILE] is not None
+    assert mtimes[ni.GALLERY_FILE] is None
+
+LOCAL = "127.0.0.1"
+PROFILE = {"X-Profile": "1"}
+
+def capture(profiler, headers=PROFILE, client_host=LOCAL):
+    """Take and save a capture, returning its request id."""
+    taken = profiler.start_capture(headers, client_host)
+    taken.profile.enable()
+    sorted(range(100))
+    taken.profile.disable()
+    profiler.finish(taken)
+    # Keep directory mtimes and timestamps apart
+    time.sleep(0.01)
+    return taken.request_id
+
+def test_profiler_rate_limits_captures(tmp_path):
+    profiler = ni.Profiler(str(tmp_path), min_interval=60)
+
+    assert profiler.start_capture({}, LOCAL) is None
+    assert profiler.start_capture(PROFILE, LOCAL) is not None
+    assert profiler.start_capture(PROFILE, LOCAL) is None
+
+def test_profiler_ignores_header_from_remote_clients(tmp_path):
+    profiler = ni.Profiler(str(tmp_path), min_interval=60)
+
+    assert profiler.start_capture(PROFILE, "203.0.113.7") is None
+    # The remote request didn't use up the rate limit
+    assert profiler.start_capture(PROFILE, LOCAL) is not None
+
+def test_profiler_admin_toggle_profiles_any_client(tmp_path):
+    profiler = ni.Profiler(str(tmp_path), min_interval=0)
+    profiler.enabled = True
+
+    assert profiler.start_capture({}, "203.0.113.7") is not None
+
+def test_profiler_sanitises_request_ids(tmp_path):
+    profiler = ni.Profiler(str(tmp_path), min_interval=0)
+
+    assert capture(profiler, dict(PROFILE, **{"X-Request-ID": "upload-42"})) == "upload-42"
+    # Reused ids and unsafe ids both get a generated one instead
+    reused = capture(profiler, dict(PROFILE, **{"X-Request-ID": "upload-42"}))
+    unsafe = capture(profiler, dict(PROFILE, **{"X-Request-ID": "../../etc"}))
+    assert reused != "upload-42"
+    assert "/" not in unsafe and "." not in unsafe
+    assert sorted(os.listdir(tmp_path)) == sorted(["upload-42", reused, unsafe])
+
+def test_profiler_prunes_to_max_captures(tmp_path):
+    profiler = ni.Profiler(str(tmp_path), min_interval=0, max_captures=3)
+    ids = [capture(profiler) for _ in range(5)]
+
+    assert sorted(os.listdir(tmp_path)) == sorted(ids[-3:])
+
+def test_profiler_prunes_broken_captures(tmp_path):
+    profiler = ni.Profiler(str(tmp_path), min_interval=0, max_captures=2)
+    broken = tmp_path / "broken"
+    broken.mkdir()
+    time.sleep(0.01)
+    ids = [capture(profiler) for _ in range(2)]
+
+    assert sorted(os.listdir(tmp_path)) == sorted(ids)
+
+def test_profiler_removes_capture_that_fails_to_save(tmp_path):
+    profiler = ni.Profiler(str(tmp_path), min_interval=0)
+    failed = profiler.start_capture(PROFILE, LOCAL)
+
+    def save():
+        raise OSError("disk full")
+
+    failed.save = save
+    profiler.finish(failed)
+
+    assert not os.path.exists(failed.path)
+
+def test_profiler_lists_newest_captures_first(tmp_path):
+    profiler = ni.Profiler(str(tmp_path), min_interval=0)
+    ids = [capture(profiler) for _ in range(3)]
+
+    assert [metadata["request_id"] for metadata in profiler.captures()] == ids[::-1]
+    assert [metadata["request_id"] for metadata in profiler.captures(2)] == ids[:0:-1]